@@ -1,14 +1,78 @@
+import base64
+import email.utils
+import os
+import random
 import requests
+import shutil
 import time
-from requests.auth import HTTPBasicAuth
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # default number of bytes copied from the network stream to the backup file per read
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024 # size of the write buffer of the local backup file
+MAX_RETRY_DELAY = 30 # upper bound in seconds for the wait between two retries of a failed request
+RETRY_STATUS_CODES = (429, 502, 503, 504) # rate limited or temporarily unavailable, worth another attempt
+REQUEST_TIMEOUT = (10, 60) # seconds to wait for the connection to be established and for data to arrive
+JSON_HEADERS = {'Content-Type': 'application/json'} # headers of the requests to the backup REST endpoints
+DOWNLOAD_HEADERS = {'Accept-Encoding': 'identity'} # the backup is a zip archive already, so don't compress it again
+_UNSAFE_CHARS = str.maketrans({c: '_' for c in '/\\:*?"<>|'}) # characters which are not allowed in folder names
+
+def sanitize_folder_name(url):
+    # Turn the site URL into a folder name which is valid on every file system
+    for scheme in ('https://', 'http://'):
+        if url.startswith(scheme):
+            url = url[len(scheme):]
+            break
+    return url.translate(_UNSAFE_CHARS).strip('_')
+
+def _parse_retry_after(value):
+    # Retry-After holds either a number of seconds or an HTTP date
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def _expected_size(response, resume_from):
+    # Total size of the archive according to the response, None if the server did not tell
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    if response.status_code == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+    length = response.headers.get('Content-Length', '')
+    if not length.isdigit():
+        return None
+    return int(length) + (resume_from if response.status_code == 206 else 0)
+
+class _BasicAuth(AuthBase):
+    # Basic auth like requests' HTTPBasicAuth, but the header is encoded once instead of on every request
+    def __init__(self, username, password):
+        credentials = base64.b64encode(f'{username}:{password}'.encode('latin1')).decode('ascii')
+        self.header = f'Basic {credentials}'
+
+    def __call__(self, request):
+        request.headers['Authorization'] = self.header
+        return request
 
 class AtlassianCloudBackup:
 
-    def __init__(self, jira_url, username, api_token, logging):
+    def __init__(self, jira_url, username, api_token, logging, poll_interval=60, max_retries=3, chunk_size=DOWNLOAD_CHUNK_SIZE, max_wait=6 * 3600, backup_folder='.'):
         self.jira_url = jira_url
         self.username = username
         self.api_token = api_token
         self.logging = logging
+        self.poll_interval = poll_interval # maximum seconds to wait between two progress checks of the backup task
+        self.max_retries = max_retries # how often a rate limited or failed request is retried before giving up
+        self.chunk_size = chunk_size # bytes copied from the network stream to the backup file per read
+        self.max_wait = max_wait # seconds to wait for the backup task to complete before giving up
+        self._task_progress = {} # ETag and body of the last progress response, keyed by task ID
 
         self.BACKUP_TASKID = "/rest/backup/1/export/lastTaskId" # the path of the endpoint to get the last task ID which is our backup task ID
         self.BACKUP_PROGRESS = "/rest/api/3/task/" # the path of the endpoint to get the progress of the backup task
@@ -17,29 +81,103 @@ class AtlassianCloudBackup:
 
         if not all([self.jira_url, self.username, self.api_token]):
             raise EnvironmentError("Please set the JIRA_URL, JIRA_USERNAME, and JIRA_API_TOKEN environment variables.")
-        
+        if self.poll_interval < 1:
+            raise ValueError(f"The poll interval must be at least 1 second, got {self.poll_interval}.")
+        if self.chunk_size < 1:
+            raise ValueError(f"The download chunk size must be at least 1 byte, got {self.chunk_size}.")
+
+        self.jira_url = self.jira_url.rstrip('/')
+        self.backup_folder = os.path.abspath(backup_folder) # the folder the backup files of this site are stored in
+        os.makedirs(self.backup_folder, exist_ok=True)
+
+        # the full URLs of the endpoints, the task ID is appended to the progress and download ones
+        self._task_id_url = f'{self.jira_url}{self.BACKUP_TASKID}'
+        self._progress_url = f'{self.jira_url}{self.BACKUP_PROGRESS}'
+        self._download_info_url = f'{self.jira_url}{self.BACKUP_DOWNLOAD}'
+        self._trigger_url = f'{self.jira_url}{self.BACKUP_TRIGGER}'
+
+        # Share one session between all requests, so polling and downloading reuse the
+        # already established TLS connections to the site
+        self.session = requests.Session()
+        # Set as session auth, not as a plain header, so requests never replaces it with netrc credentials
+        self.session.auth = _BasicAuth(self.username, self.api_token)
+        self.session.headers['User-Agent'] = 'atlassian-cloud-backup'
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    def close(self):
+        # Release the pooled connections of the session
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method, url, idempotent=True, **kwargs):
+        # Atlassian Cloud answers with 429 when we exceed its rate limit and with 502-504 when
+        # it is temporarily unavailable, and the connection itself may drop or stall. Wait as
+        # long as the Retry-After header asks for, or back off exponentially if it is missing.
+        # A request which is not idempotent may have been carried out already when the
+        # connection fails or the gateway gives up, so it is only retried if it cannot have
+        # reached Jira: on a connect timeout or when it was rate limited.
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+        delay = 1
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if last_attempt or not (idempotent or isinstance(error, requests.ConnectTimeout)):
+                    raise
+                reason, wait = error, None
+            else:
+                if response.status_code not in retry_status_codes or last_attempt:
+                    return response
+                reason = response.status_code
+                wait = _parse_retry_after(response.headers.get('Retry-After', ''))
+                response.close()
+
+            # Jitter our own backoff by +-50%, so parallel site backups do not retry in lockstep
+            if wait is None:
+                wait = delay * random.uniform(0.5, 1.5)
+            self.logging.warning("Request to %s failed with %s, retrying in %.1f seconds...", url, reason, wait)
+            time.sleep(wait)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
     def _get_json_response(self, url):
-        response = requests.get(
-            url,
-            auth=HTTPBasicAuth(self.username, self.api_token),
-            headers={'Content-Type': 'application/json'}
-        )
+        response = self._request('GET', url, headers=JSON_HEADERS)
         return response.json()
     
     def get_backup_task_id(self):
-        url = f'{self.jira_url}{self.BACKUP_TASKID}'   # the full URL of the endpoint to use for the request
-        return self._get_json_response(url)
+        return self._get_json_response(self._task_id_url)
     
     def _get_task_progress(self, task_id):
-        url = f'{self.jira_url}{self.BACKUP_PROGRESS}{task_id}'
-        return self._get_json_response(url)
+        # Send the ETag of the last progress response along, so Jira can answer with
+        # 304 Not Modified instead of the full body when nothing changed
+        etag, progress = self._task_progress.get(task_id, (None, None))
+        headers = {**JSON_HEADERS, 'If-None-Match': etag} if etag else JSON_HEADERS
+
+        response = self._request('GET', f'{self._progress_url}{task_id}', headers=headers)
+        if response.status_code == 304:
+            return progress
+
+        progress = response.json()
+        self._task_progress[task_id] = (response.headers.get('ETag'), progress)
+        return progress
     
     def _get_download_url(self, task_id):
-        url = f'{self.jira_url}{self.BACKUP_DOWNLOAD}{task_id}'
-        response = self._get_json_response(url)
-        return f'{self.jira_url}/plugins/servlet/{response.get("result")}'
+        response = self._get_json_response(f'{self._download_info_url}{task_id}')
+        result = response.get("result")
+        if not result:
+            raise RuntimeError(f"Jira returned no download URL for backup {task_id}: {response}")
+        return f'{self.jira_url}/plugins/servlet/{result}'
     
     def wait_for_backup_to_complete(self, task_id):
+        # Start polling quickly so short backups are noticed within seconds and slow down
+        # to poll_interval for long running ones.
+        delay = 1
+        deadline = time.monotonic() + self.max_wait
         while True:
             backup_status = self._get_task_progress(task_id)
         
@@ -53,30 +191,80 @@ class AtlassianCloudBackup:
                 self.logging.error("Backup failed.")
                 return False
             elif status == 'RUNNING' or status == 'ENQUEUED':
-                self.logging.info("Backup in progress..." + str(progress))
-                time.sleep(60)
+                self.logging.info("Backup in progress...%s", progress)
+                if time.monotonic() + delay > deadline:
+                    self.logging.error("Backup did not complete within %s seconds.", self.max_wait)
+                    return False
+                time.sleep(delay)
+                delay = max(1, min(delay * 1.5, self.poll_interval))
             else:
-                self.logging.info(f"Backup in status {backup_status}!")
+                self.logging.info("Backup in status %s!", backup_status)
                 return False
 
+    def _get_backup_file_path(self, task_id):
+        return os.path.join(self.backup_folder, f'jira_backup_{task_id}.zip')
+
+    def backup_file_exists(self, task_id):
+        # Finished downloads are renamed from their .part file, so an existing file is complete
+        return os.path.exists(self._get_backup_file_path(task_id))
+
     def download_backup_file(self, task_id):
         download_url = self._get_download_url(task_id)
-        local_file_path = f'jira_backup_{task_id}.zip'
+        local_file_path = self._get_backup_file_path(task_id)
 
-        self.logging.info(f"Downloading backup file from {download_url}...")
-        response = requests.get(
-            download_url,
-            auth=HTTPBasicAuth(self.username, self.api_token),
-            stream=True
-        )
-        with open(local_file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
+        # Download into a temporary file and rename it when done, so an interrupted
+        # download never leaves a truncated backup under the final name
+        part_file_path = f'{local_file_path}.part'
 
-    def trigger_backup(self):
-        # Endpoint to trigger backup
-        backup_url = f'{self.jira_url}/rest/backup/1/export/runbackup'
+        self.logging.info("Downloading backup file from %s...", download_url)
+        if not self._download_part_file(download_url, part_file_path):
+            # The partial file does not match the archive on the server, so start over
+            self.logging.warning("Cannot resume download into %s, downloading it again.", part_file_path)
+            os.remove(part_file_path)
+            self._download_part_file(download_url, part_file_path)
+        os.replace(part_file_path, local_file_path)
 
+    def _download_part_file(self, download_url, part_file_path):
+        # Returns False if an existing partial download cannot be resumed
+
+        # Continue an interrupted download of the same task instead of starting over
+        try:
+            resume_from = os.stat(part_file_path).st_size
+        except FileNotFoundError:
+            resume_from = 0
+        headers = {**DOWNLOAD_HEADERS, 'Range': f'bytes={resume_from}-'} if resume_from else DOWNLOAD_HEADERS
+
+        with self._request('GET', download_url, headers=headers, stream=True) as response:
+            if response.status_code == 416 and resume_from:
+                # A range starting right at the end of the file cannot be satisfied: an earlier
+                # attempt already received every byte and only missed the rename
+                if response.headers.get('Content-Range') == f'bytes */{resume_from}':
+                    self.logging.info("Backup file %s was already downloaded completely.", part_file_path)
+                    return True
+                return False
+
+            response.raise_for_status()
+            response.raw.decode_content = True
+            expected_size = _expected_size(response, resume_from)
+
+            # Only append if the server honoured the range, otherwise it sends the whole file
+            mode = "ab" if response.status_code == 206 else "wb"
+            if mode == "ab":
+                self.logging.info("Resuming download at %s bytes...", resume_from)
+            with open(part_file_path, mode, buffering=WRITE_BUFFER_SIZE) as f:
+                shutil.copyfileobj(response.raw, f, self.chunk_size)
+                # Make sure the data is on disk before the rename marks the backup as complete
+                f.flush()
+                os.fsync(f.fileno())
+                size = os.fstat(f.fileno()).st_size
+
+        # The connection may close before the whole archive arrived without an error being
+        # raised, so keep the partial file for the next run to resume instead of renaming it
+        if expected_size is not None and size != expected_size:
+            raise IOError(f"Received {size} of {expected_size} bytes of {part_file_path}, the download is incomplete.")
+        return True
+
+    def trigger_backup(self):
         # Payload to trigger backup
         payload = {
             "cbAttachments": True,  # Set to True if you want to include attachments
@@ -84,10 +272,11 @@ class AtlassianCloudBackup:
         }
 
         # Trigger the backup
-        response = requests.post(
-            backup_url,
-            auth=HTTPBasicAuth(self.username, self.api_token),
-            headers={'Content-Type': 'application/json'},
+        response = self._request(
+            'POST',
+            self._trigger_url,
+            idempotent=False,
+            headers=JSON_HEADERS,
             json=payload
         )
 
@@ -95,7 +284,7 @@ class AtlassianCloudBackup:
         if success:
             self.logging.info("Backup triggered successfully.")
         else:
-            self.logging.error(f"Failed to trigger backup: {response.status_code}")
+            self.logging.error("Failed to trigger backup: %s", response.status_code)
             self.logging.error(response.text)
 
         return success
\ No newline at end of file
@@ -1,25 +1,95 @@
 import os
+import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from backup import AtlassianCloudBackup
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("atlassian_cloud_backup.log"),
-        logging.StreamHandler()]
-    )
-
-# Read environment variables from OS
-backup = AtlassianCloudBackup(
-    os.getenv('JIRA_URL'),
-    os.getenv('JIRA_USERNAME'),
-    os.getenv('JIRA_API_TOKEN'),
-    logging
-)
-
-taskid = backup.get_backup_task_id()
-backup.wait_for_backup_to_complete(taskid)
-backup.download_backup_file(taskid)
\ No newline at end of file
+LOG_FORMAT = '%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
+
+def run_backup(jira_url, username, api_token, force_download, **options):
+    from backup import AtlassianCloudBackup
+
+    with AtlassianCloudBackup(jira_url, username, api_token, logging, **options) as backup:
+        taskid = backup.get_backup_task_id()
+        if not force_download and backup.backup_file_exists(taskid):
+            logging.info("Backup %s of %s is already downloaded, skipping it.", taskid, backup.jira_url)
+            return
+        if not backup.wait_for_backup_to_complete(taskid):
+            raise RuntimeError(f"Backup {taskid} of {backup.jira_url} did not complete.")
+        backup.download_backup_file(taskid)
+
+def main():
+    # Configure logging, the log file is added once the configuration has been validated
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[logging.StreamHandler()]
+        )
+
+    # Set FORCE_DOWNLOAD to download backups again even if they are already on disk
+    force_download = os.getenv('FORCE_DOWNLOAD', '').lower() in ('1', 'true', 'yes')
+
+    # Read environment variables from OS
+    # JIRA_URL may contain a comma separated list of sites, which are backed up in parallel
+    jira_urls = [url for url in map(str.strip, os.getenv('JIRA_URL', '').split(',')) if url]
+    username = os.getenv('JIRA_USERNAME')
+    api_token = os.getenv('JIRA_API_TOKEN')
+    poll_interval = int(os.getenv('JIRA_POLL_INTERVAL', 60))
+    max_wait = int(os.getenv('JIRA_WAIT_DEADLINE', 6 * 3600))
+    # BACKUP_WORKERS caps the number of sites backed up at the same time
+    max_workers = int(os.getenv('BACKUP_WORKERS', 8))
+    missing = [name for name, value in (('JIRA_URL', jira_urls), ('JIRA_USERNAME', username), ('JIRA_API_TOKEN', api_token)) if not value]
+    if missing:
+        raise EnvironmentError(f"Please set the {', '.join(missing)} environment variable(s).")
+    if max_workers < 1:
+        raise ValueError(f"BACKUP_WORKERS must be at least 1, got {max_workers}.")
+
+    file_handler = logging.FileHandler("atlassian_cloud_backup.log")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(file_handler)
+
+    # Import the backup client, and requests with it, only once the configuration is complete
+    from backup import DOWNLOAD_CHUNK_SIZE, sanitize_folder_name
+
+    chunk_size = int(os.getenv('JIRA_DOWNLOAD_CHUNK_SIZE', DOWNLOAD_CHUNK_SIZE))
+
+    # Back up a site listed twice only once, even with another scheme, case or trailing
+    # slash, as both workers would write to the same backup file
+    sites = {}
+    for jira_url in jira_urls:
+        sites.setdefault(sanitize_folder_name(jira_url).lower(), jira_url)
+    jira_urls = list(sites.values())
+
+    # A single site keeps storing its backups in the working directory, several sites get
+    # a folder each, as their task IDs are only unique per site
+    backup_folders = {jira_url: sanitize_folder_name(jira_url) if len(jira_urls) > 1 else '.' for jira_url in jira_urls}
+
+    # Each site is set up inside its worker, so a site which fails to set up is
+    # reported like any other failing site and does not stop the others
+    failed = False
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jira_urls)), thread_name_prefix='backup') as executor:
+        futures = {
+            executor.submit(
+                run_backup,
+                jira_url,
+                username,
+                api_token,
+                force_download,
+                poll_interval=poll_interval,
+                chunk_size=chunk_size,
+                max_wait=max_wait,
+                backup_folder=backup_folders[jira_url]
+            ): jira_url
+            for jira_url in jira_urls
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Backup of %s failed.", futures[future])
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()